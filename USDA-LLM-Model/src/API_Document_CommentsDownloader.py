@@ -1,14 +1,48 @@
+import asyncio
+import aiohttp
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 import os
 import json
 import re
-from time import sleep
+import gzip
+import glob
+import hashlib
+import time
+import mimetypes
+from email.message import Message
+from urllib.parse import urlsplit, urlunsplit, parse_qsl, urlencode
 
 # API base URLs and your API key
 DOCUMENTS_URL = "https://api.regulations.gov/v4/documents"
 COMMENTS_URL = "https://api.regulations.gov/v4/comments"
 API_KEY = "YOUR REGULATIONS.GOV API KEY HERE"
 
+# Concurrency limits for the async downloader
+MAX_CONNECTIONS = 20  # Open connections shared by all requests
+MAX_CONCURRENT_COMMENTS = 10  # Comments fetched at once, to respect regulations.gov rate limits
+MAX_RETRIES = 5  # Attempts per request when the API answers HTTP 429 or the connection fails
+RETRY_BACKOFF = 0.3  # Seconds before the first retry after a network error, doubling on each attempt
+# No overall limit, so large attachments can take as long as they need; only stalled connections time out
+REQUEST_TIMEOUT = aiohttp.ClientTimeout(total=None, sock_connect=30, sock_read=120)
+PAGE_CONSUMERS = 2  # Pages processed at once while the next page listing is prefetched
+DOWNLOAD_CHUNK_SIZE = 1 << 20  # Bytes read and written per step when saving attachments
+ATTACHMENTS_DIR = "./Downloads/USDA_JSON/attachments"  # Attachments already saved here are not downloaded again
+
+# On-disk cache of API responses, so re-runs and resumed runs skip the network
+CACHE_DIR = "./cache"
+CACHE_TTL = 7 * 24 * 60 * 60  # Seconds before a cached response is fetched again
+
+# Shared session for synchronous requests, reusing keep-alive connections and retrying transient errors
+SESSION = requests.Session()
+SESSION.mount("https://", HTTPAdapter(
+    pool_connections=MAX_CONNECTIONS,
+    pool_maxsize=MAX_CONNECTIONS,
+    max_retries=Retry(total=MAX_RETRIES, backoff_factor=0.3, status_forcelist=[429, 500, 502, 503, 504],
+                      raise_on_status=False)
+))
+
 def extract_docket_id_or_document_id(link):
     """
     Extracts the docket ID or document ID from the provided regulations.gov link.
@@ -24,104 +58,230 @@ def extract_docket_id_or_document_id(link):
     print("Invalid link format. Could not extract docket or document ID.")
     return None, None
 
+def get_cache_path(url):
+    """
+    Returns the cache file for a URL, keyed by a hash of the URL without its api_key parameter.
+    """
+    parts = urlsplit(url)
+    query = [(key, value) for key, value in parse_qsl(parts.query) if key != "api_key"]
+    cache_key = urlunsplit(parts._replace(query=urlencode(query)))
+    return os.path.join(CACHE_DIR, hashlib.sha256(cache_key.encode("utf-8")).hexdigest() + ".json.gz")
+
+def load_cached_response(url):
+    """
+    Returns the cached JSON body for a URL, or None if it is missing, expired or unreadable.
+    """
+    cache_path = get_cache_path(url)
+    try:
+        if time.time() - os.path.getmtime(cache_path) > CACHE_TTL:
+            return None
+        with gzip.open(cache_path, "rt", encoding="utf-8") as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+def save_cached_response(url, data):
+    """
+    Stores the JSON body of a successful response in the cache.
+    """
+    cache_path = get_cache_path(url)
+    os.makedirs(CACHE_DIR, exist_ok=True)
+    temp_path = f"{cache_path}.tmp"
+    with gzip.open(temp_path, "wt", encoding="utf-8") as f:
+        json.dump(data, f, ensure_ascii=False)
+    os.replace(temp_path, cache_path)  # Never leave a partially written entry behind
+
 def fetch_object_id_from_document(document_id):
     """
     Fetches the objectId for a specific document ID.
     """
     url = f"{DOCUMENTS_URL}/{document_id}?api_key={API_KEY}"
-    response = requests.get(url)
+    cached = load_cached_response(url)
+    if cached is not None:
+        return cached.get("data", {}).get("attributes", {}).get("objectId")
+
+    response = SESSION.get(url)
     if response.status_code == 200:
+        save_cached_response(url, response.json())
         return response.json().get("data", {}).get("attributes", {}).get("objectId")
     else:
         print(f"Error fetching document: {response.status_code} - {response.text}")
         return None
 
-def fetch_full_comment_data(self_link):
+def get_retry_delay(response):
+    """
+    Returns the number of seconds to wait before retrying an HTTP 429 response.
+    """
+    try:
+        return float(response.headers.get("Retry-After", 1))
+    except ValueError:
+        return 1.0  # Retry-After may also be an HTTP date; fall back to a short pause
+
+async def get_json(session, url):
+    """
+    Performs a GET request and returns (status, body), where body is the parsed JSON on success
+    or the response text otherwise. HTTP 429 responses are retried after the Retry-After delay;
+    network errors and malformed JSON bodies are retried with backoff (status is None if the last attempt hit one).
+    Successful responses are served from and stored in the on-disk cache.
+    """
+    cached = load_cached_response(url)
+    if cached is not None:
+        return 200, cached
+
+    for attempt in range(MAX_RETRIES):
+        try:
+            async with session.get(url) as response:
+                status = response.status
+                if status == 200:
+                    # regulations.gov answers with application/vnd.api+json, so skip the content type check
+                    data = await response.json(content_type=None)
+                    save_cached_response(url, data)
+                    return status, data
+                if status != 429:
+                    return status, await response.text()
+                body = "Too many requests"
+                delay = get_retry_delay(response)
+            print(f"Rate limited on {url}, retrying in {delay} seconds...")
+        except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+            status, body = None, f"{type(e).__name__}: {e}"
+            delay = RETRY_BACKOFF * 2 ** attempt
+            print(f"Network error on {url} ({body}), retrying in {delay} seconds...")
+        except ValueError as e:
+            # A 200 with a truncated or malformed JSON body
+            status, body = None, f"Invalid JSON: {e}"
+            delay = RETRY_BACKOFF * 2 ** attempt
+            print(f"Invalid response from {url} ({body}), retrying in {delay} seconds...")
+        await asyncio.sleep(delay)
+    return status, body
+
+async def fetch_full_comment_data(session, self_link):
     """
     Fetches the full comment details using the 'self' link.
     """
     url = f"{self_link}?api_key={API_KEY}"
-    response = requests.get(url)
-    if response.status_code == 200:
-        return response.json().get("data", {})
+    status, body = await get_json(session, url)
+    if status == 200:
+        return body.get("data", {})
     else:
-        print(f"Error fetching full comment data: {response.status_code} - {response.text}")
+        print(f"Error fetching full comment data: {status} - {body}")
         return None
 
-def get_comments_by_object_id(object_id, page_size=250, page_number=1):
+async def get_comments_by_object_id(session, object_id, page_size=250, page_number=1):
     """
     Fetches a page of comments for a specific objectId.
     """
     url = f"{COMMENTS_URL}?filter[commentOnId]={object_id}&page[size]={page_size}&page[number]={page_number}&api_key={API_KEY}"
     url += "&sort=lastModifiedDate"
 
-    response = requests.get(url)
-    if response.status_code == 200:
-        return response.json()
+    status, body = await get_json(session, url)
+    if status == 200:
+        return body
     else:
-        print(f"Error fetching comments: {response.status_code} - {response.text}")
+        print(f"Error fetching comments: {status} - {body}")
         return None
 
-def fetch_all_comments(object_id, filename, total_comments):
+async def fetch_comment(session, semaphore, comment):
     """
-    Fetches all comments for a given objectId, including only the required fields and downloading attachments.
+    Fetches the full data and attachments for a single comment from a listing page.
+    Returns the cleaned comment, or None if it could not be retrieved.
+    """
+    if "links" not in comment or "self" not in comment["links"]:
+        return None
+
+    async with semaphore:
+        full_comment = await fetch_full_comment_data(session, comment["links"]["self"])
+        if not full_comment:
+            return None
+
+        # Extract required fields
+        comment_id = full_comment.get("id", "")
+        comment_text = full_comment.get("attributes", {}).get("comment", "")
+        attachments_metadata = await fetch_attachments(session, comment_id)
+
+    return {
+        "comment_id": comment_id,
+        "text": comment_text,
+        "attachments": attachments_metadata
+    }
+
+async def produce_pages(session, object_id, page_size, total_comments, queue):
+    """
+    Fetches listing pages for a given objectId and puts (page_number, comments) on the queue.
+    The next page is requested as soon as the current one is queued, so listing overlaps with
+    the per-comment downloads. Finishes by putting one None per consumer on the queue.
     """
-    cleaned_comments = []
     page_number = 1
-    page_size = 250  # Default page size for maximum efficiency
-    downloaded_comments = 0
+    listed_comments = 0
 
-    while True:
-        print(f"Fetching page {page_number} for objectId {object_id}...")
-        response = get_comments_by_object_id(object_id, page_size=page_size, page_number=page_number)
+    try:
+        while listed_comments < total_comments:
+            print(f"Fetching page {page_number} for objectId {object_id}...")
+            response = await get_comments_by_object_id(session, object_id, page_size=page_size, page_number=page_number)
+
+            if not response or "data" not in response or not response["data"]:
+                break  # Exit loop if no more data
 
-        if not response or "data" not in response or not response["data"]:
-            break  # Exit loop if no more data
+            # Only queue as many comments as are still needed
+            page = response["data"]
+            if total_comments != float("inf"):
+                page = page[:total_comments - listed_comments]
+            listed_comments += len(page)
+            await queue.put((page_number, page))
 
-        for comment in response["data"]:
-            if downloaded_comments >= total_comments:
+            if len(response["data"]) < page_size:
                 break
 
-            if "links" in comment and "self" in comment["links"]:
-                full_comment = fetch_full_comment_data(comment["links"]["self"])
-                if full_comment:
-                    # Extract required fields
-                    comment_id = full_comment.get("id", "")
-                    comment_text = full_comment.get("attributes", {}).get("comment", "")
-                    attachments_metadata = fetch_attachments(comment_id)
+            page_number += 1
+    finally:
+        for _ in range(PAGE_CONSUMERS):
+            await queue.put(None)
 
-                    # Add the cleaned comment to the list
-                    cleaned_comment = {
-                        "comment_id": comment_id,
-                        "text": comment_text,
-                        "attachments": attachments_metadata
-                    }
-                    cleaned_comments.append(cleaned_comment)
+async def consume_pages(session, semaphore, queue, filename):
+    """
+    Takes pages off the queue, fetches their comments concurrently and saves each page.
+    Returns the number of comments downloaded.
+    """
+    downloaded_comments = 0
 
-                    # Increment comment counter
-                    downloaded_comments += 1
+    while True:
+        item = await queue.get()
+        if item is None:
+            return downloaded_comments
 
-            sleep(0.1)  # Avoid overwhelming the API with rapid requests
+        page_number, page = item
+        tasks = [fetch_comment(session, semaphore, comment) for comment in page]
+        cleaned_comments = [c for c in await asyncio.gather(*tasks) if c]
+        downloaded_comments += len(cleaned_comments)
 
         save_comments_incrementally(cleaned_comments, filename, page_number)
-        cleaned_comments = []  # Reset for next batch
 
-        if downloaded_comments >= total_comments or len(response["data"]) < page_size:
-            break
+async def fetch_all_comments(object_id, filename, total_comments):
+    """
+    Fetches all comments for a given objectId, including only the required fields and downloading attachments.
+    Comments are fetched concurrently over a single shared session while the next page is being listed.
+    """
+    page_size = 250  # Default page size for maximum efficiency
+    semaphore = asyncio.Semaphore(MAX_CONCURRENT_COMMENTS)
+    queue = asyncio.Queue(maxsize=PAGE_CONSUMERS)
+    connector = aiohttp.TCPConnector(limit=MAX_CONNECTIONS)
 
-        page_number += 1
+    async with aiohttp.ClientSession(connector=connector, timeout=REQUEST_TIMEOUT) as session:
+        producer = produce_pages(session, object_id, page_size, total_comments, queue)
+        consumers = [consume_pages(session, semaphore, queue, filename) for _ in range(PAGE_CONSUMERS)]
+        results = await asyncio.gather(producer, *consumers)
 
+    downloaded_comments = sum(results[1:])
     print(f"Completed fetching {downloaded_comments} comments for objectId {object_id}.")
 
-def fetch_attachments(comment_id):
+async def fetch_attachments(session, comment_id):
     """
     Fetches and downloads attachments for a specific comment.
     """
     attachments_url = f"https://api.regulations.gov/v4/comments/{comment_id}/attachments?api_key={API_KEY}"
-    response = requests.get(attachments_url)
-    if response.status_code == 200:
+    status, body = await get_json(session, attachments_url)
+    if status == 200:
         attachments_metadata = []
-        attachments = response.json().get("data", [])
+        attachments = body.get("data", [])
         for attachment_index, attachment in enumerate(attachments):
             file_formats = attachment.get("attributes", {}).get("fileFormats", [])
             if not isinstance(file_formats, list):
@@ -130,52 +290,89 @@ def fetch_attachments(comment_id):
             for file_format in file_formats:
                 file_url = file_format.get("fileUrl")
                 if file_url:
-                    file_path = download_file(file_url, comment_id, attachment_index)
+                    file_path = await download_file(session, file_url, comment_id, attachment_index)
                     attachments_metadata.append({"url": file_url, "file_path": file_path})
         return attachments_metadata
     else:
-        print(f"Failed to retrieve attachments for comment {comment_id}: {response.status_code}")
+        print(f"Failed to retrieve attachments for comment {comment_id}: {status} - {body}")
         return []
 
-def download_file(url, comment_id, attachment_index):
+def find_downloaded_file(url, comment_id, attachment_index):
     """
-    Downloads a single file from the provided URL and saves it with the appropriate extension.
+    Returns the path of an attachment saved by an earlier run, or None if it still has to be downloaded.
+    Matches on the URL's extension when it has one, since one attachment can come in several formats.
     """
-    response = requests.get(url, stream=True)
-    if response.status_code == 200:
-        # Determine file extension
-        content_type = response.headers.get("Content-Type")
-        extension = get_extension_from_content_type(content_type)
-        if not extension:
-            extension = "dat"  # Default extension if type is unknown
-
-        # Save the file with a unique name
-        os.makedirs("./Downloads/USDA_JSON/attachments", exist_ok=True)
-        file_path = f"./Downloads/USDA_JSON/attachments/{comment_id}_{attachment_index}.{extension}"
-        with open(file_path, "wb") as file:
-            for chunk in response.iter_content(chunk_size=8192):
-                file.write(chunk)
-        print(f"Downloaded attachment {attachment_index} for comment {comment_id} to {file_path}")
-        return file_path
-    else:
-        print(f"Failed to download file from {url}: {response.status_code}")
-        return None
+    extension = os.path.splitext(urlsplit(url).path)[1].lower()
+    pattern = os.path.join(ATTACHMENTS_DIR, f"{glob.escape(f'{comment_id}_{attachment_index}')}{extension or '.*'}")
+    matches = [path for path in glob.glob(pattern) if not path.endswith(".part")]
+    return matches[0] if matches else None
 
-def get_extension_from_content_type(content_type):
+async def download_file(session, url, comment_id, attachment_index):
     """
-    Maps Content-Type to a file extension.
+    Downloads a single file from the provided URL and saves it with the appropriate extension.
+    Files are written under a .part name and renamed when complete, so finished files are skipped on re-runs.
     """
-    if content_type == "application/pdf":
-        return "pdf"
-    elif content_type == "image/jpeg":
-        return "jpg"
-    elif content_type == "image/png":
-        return "png"
-    elif content_type == "application/zip":
-        return "zip"
-    # Add more content types as needed
+    existing_path = find_downloaded_file(url, comment_id, attachment_index)
+    if existing_path:
+        print(f"Attachment {attachment_index} for comment {comment_id} already downloaded to {existing_path}")
+        return existing_path
+
+    for attempt in range(MAX_RETRIES):
+        file_path = None
+        try:
+            async with session.get(url) as response:
+                if response.status == 200:
+                    # Determine file extension
+                    extension = get_file_extension(url, response.headers)
+
+                    # Save the file with a unique name
+                    os.makedirs(ATTACHMENTS_DIR, exist_ok=True)
+                    file_path = f"{ATTACHMENTS_DIR}/{comment_id}_{attachment_index}.{extension}"
+                    with open(file_path + ".part", "wb", buffering=DOWNLOAD_CHUNK_SIZE) as file:
+                        async for chunk in response.content.iter_chunked(DOWNLOAD_CHUNK_SIZE):
+                            file.write(chunk)
+                    os.replace(file_path + ".part", file_path)
+                    print(f"Downloaded attachment {attachment_index} for comment {comment_id} to {file_path}")
+                    return file_path
+                if response.status != 429:
+                    print(f"Failed to download file from {url}: {response.status}")
+                    return None
+                error = "429"
+                delay = get_retry_delay(response)
+            print(f"Rate limited on {url}, retrying in {delay} seconds...")
+        except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+            if file_path and os.path.exists(file_path + ".part"):
+                os.remove(file_path + ".part")  # Don't leave a partially downloaded file behind
+            error = f"{type(e).__name__}: {e}"
+            delay = RETRY_BACKOFF * 2 ** attempt
+            print(f"Network error on {url} ({error}), retrying in {delay} seconds...")
+        await asyncio.sleep(delay)
+
+    print(f"Failed to download file from {url}: {error}")
     return None
 
+def get_file_extension(url, headers):
+    """
+    Determines a file extension from the Content-Disposition filename, the URL path or the Content-Type, in that order.
+    """
+    content_disposition = headers.get("Content-Disposition")
+    if content_disposition:
+        message = Message()
+        message["Content-Disposition"] = content_disposition
+        filename = message.get_filename()
+        if filename and os.path.splitext(filename)[1]:
+            return os.path.splitext(filename)[1].lstrip(".").lower()
+
+    path_extension = os.path.splitext(urlsplit(url).path)[1]
+    if path_extension:
+        return path_extension.lstrip(".").lower()
+
+    content_type = (headers.get("Content-Type") or "").split(";")[0].strip()
+    guessed_extension = mimetypes.guess_extension(content_type) if content_type else None
+    if guessed_extension:
+        return guessed_extension.lstrip(".")
+    return "dat"  # Default extension if type is unknown
+
 def save_comments_incrementally(comments, filename, page_number):
     """
     Saves a single page of cleaned comments to a JSON file incrementally.
@@ -205,7 +402,7 @@ def main():
         if object_id:
             print(f"ObjectId retrieved: {object_id}")
             filename = f"./Downloads/USDA_JSON/comments_{id_value}.json"
-            fetch_all_comments(object_id, filename, total_comments)
+            asyncio.run(fetch_all_comments(object_id, filename, total_comments))
         else:
             print("No objectId found for the document.")
     else:
@@ -1,75 +1,167 @@
 import os
 import json
 import time
-import pandas as pd
-import pdfplumber
-from openai import OpenAI
+import asyncio
+import hashlib
+import csv
+from functools import cache
+import orjson
+from diskcache import Cache
+from concurrent.futures import ProcessPoolExecutor
+import pypdfium2 as pdfium
+from openai import OpenAI, AsyncOpenAI, RateLimitError
+import tiktoken
+from tenacity import retry, retry_if_exception_type, stop_after_attempt, wait_random_exponential
 from dotenv import load_dotenv, find_dotenv
 import pytesseract
 from pdf2image import convert_from_path
 from PIL import Image
 
-# 🔹 Load API Key Securely from .env File
-env_path = find_dotenv(".env")  # Ensures correct file is found
-if env_path:
-    load_dotenv(env_path)
-else:
-    print(" WARNING: .env file not found! Make sure it exists.")
-
-# 🔹 Retrieve API Key from Environment
-API_KEY = os.getenv("OPENAI_API_KEY")
-
-# 🔹 Check if API Key is Loaded Correctly
-if not API_KEY:
-    raise ValueError("❌ ERROR: API key not found. Ensure it is set correctly in the .env file.")
-
-# 🔹 Initialize OpenAI Client
-client = OpenAI(api_key=API_KEY)
-
 # 🔹 CONFIGURATION: Set Paths Here
 JSON_FOLDER = r"C:\Users\jcstr\Downloads\USDA_JSON"  # Path to JSON files
 PDF_FOLDER = r"C:\Users\jcstr\Downloads\USDA_JSON\attachments"  # Path to folder containing local PDFs
 OUTPUT_FILE = "processed_comments.csv"  # Output CSV file
+OUTPUT_FIELDS = [
+    "comment_id", "comment_link", "who_type", "who_name", "what", "why", "issues",
+    "scientific_legal_support", "pdf_attachments_present", "pdf_attachments_count"
+]  # Output CSV columns, in order
+CSV_FLUSH_EVERY = 50  # Flush the output CSV to disk after this many rows
 USE_API = True  # Set to False if testing without OpenAI API
-MAX_TOKENS = 50000  # Keep within OpenAI's input size limit
+USE_BATCH_API = True  # Classify comments with OpenAI Batch API jobs (each job can take up to 24h)
+MODEL = "gpt-4-turbo"  # OpenAI model used to classify comments
+BATCH_INPUT_FILE = "classification_batch.jsonl"  # Batch API requests file
+BATCH_POLL_SECONDS = 60  # How often to check on a submitted batch
+BATCH_MAX_REQUESTS = 50000  # Batch API limit on requests per job
+BATCH_MAX_BYTES = 190 * 1024 * 1024  # Batch API input files must stay under 200 MB
+BATCH_MAX_TOKENS = 2_000_000  # Enqueued token limit for MODEL on your OpenAI usage tier (jobs run one at a time)
+MAX_CONCURRENT_REQUESTS = 20  # GPT requests in flight at once when not using the Batch API
+GPT_CACHE_FOLDER = "./.gpt_cache"  # Stores GPT classifications so re-runs don't re-bill unchanged comments
+MAX_TOKENS = 50000  # Max comment tokens sent to GPT, to keep within OpenAI's input size limit
+PDF_WORKERS = min(os.cpu_count() or 1, 61)  # Processes used to extract PDF text in parallel (Windows allows at most 61)
+OCR_DPI = 150  # Resolution used to rasterize pages for OCR
+TESSERACT_CONFIG = "--psm 6 --oem 1"  # LSTM engine only, treating each page as a single block of text
 
 # 🔹 Set Tesseract Path (Only Needed for Windows)
 pytesseract.pytesseract.tesseract_cmd = r"C:\Program Files\Tesseract-OCR"  # Update this path if needed
 
 
+# 🔹 The API key, OpenAI clients, tokenizer and GPT cache are set up on first use rather than at import,
+#    because PDF worker processes re-import this module on Windows and never need them
+@cache
+def get_api_key():
+    """Loads the OpenAI API key from the .env file, raising an error if it is missing."""
+    env_path = find_dotenv(".env")  # Ensures correct file is found
+    if env_path:
+        load_dotenv(env_path)
+    else:
+        print(" WARNING: .env file not found! Make sure it exists.")
+
+    api_key = os.getenv("OPENAI_API_KEY")
+    if not api_key:
+        raise ValueError("❌ ERROR: API key not found. Ensure it is set correctly in the .env file.")
+    return api_key
+
+
+@cache
+def get_client():
+    """Returns the synchronous OpenAI client, used for the Batch API."""
+    return OpenAI(api_key=get_api_key())
+
+
+@cache
+def get_async_client():
+    """Returns the asynchronous OpenAI client, used for concurrent requests."""
+    return AsyncOpenAI(api_key=get_api_key())
+
+
+@cache
+def get_encoding():
+    """Returns the tokenizer used to truncate long comments."""
+    return tiktoken.encoding_for_model(MODEL)
+
+
+@cache
+def get_gpt_cache():
+    """Opens the on-disk GPT classification cache."""
+    return Cache(GPT_CACHE_FOLDER)
+
+
+def init_pdf_worker():
+    """Limits each PDF worker process to one Tesseract thread so workers don't oversubscribe the CPU."""
+    os.environ["OMP_THREAD_LIMIT"] = "1"
+
+
+def group_page_ranges(pages):
+    """Groups sorted page indexes into [first, last] runs of consecutive pages."""
+    ranges = []
+    for page in pages:
+        if ranges and page == ranges[-1][1] + 1:
+            ranges[-1][1] = page
+        else:
+            ranges.append([page, page])
+    return ranges
+
+
+def ocr_pdf_pages(pdf_path, first_page=None, last_page=None):
+    """
+    Rasterizes a range of PDF pages (every page by default) and returns the OCR text of each page.
+    Uses a single pdftoppm process per PDF, since PDF_WORKERS already keeps every core busy.
+    """
+    images = convert_from_path(
+        pdf_path, dpi=OCR_DPI, first_page=first_page, last_page=last_page,
+        fmt="jpeg", grayscale=True
+    )
+    return [pytesseract.image_to_string(img, config=TESSERACT_CONFIG) for img in images]
+
+
 def extract_text_from_pdf(pdf_path):
-    """Extracts text from a locally stored PDF file using both pdfplumber and OCR (Tesseract)."""
-    text = ""
+    """Extracts text from a locally stored PDF file using PDFium, running OCR (Tesseract) only on pages without text."""
+    text_pages = []  # Text of each page, in page order
 
-    #  First Try Extracting Text Normally Using pdfplumber
+    #  First Try Extracting the Embedded Text Using PDFium (image-only pages just come back empty)
     try:
-        with pdfplumber.open(pdf_path) as pdf:
-            for page in pdf.pages:
-                page_text = page.extract_text()
-                if page_text:
-                    text += page_text + "\n"
+        with pdfium.PdfDocument(pdf_path) as pdf:
+            for page in pdf:
+                text_pages.append(page.get_textpage().get_text_range().replace("\r\n", "\n"))
 
     except Exception as e:
-        print(f"⚠️ Error extracting text from {pdf_path} using pdfplumber: {e}")
+        print(f"⚠️ Error extracting text from {pdf_path} using PDFium: {e}")
 
-    # ✅ If No Text is Found, Use OCR (Tesseract)
-    if not text.strip():
-        print(f"🔍 No text found in {pdf_path}, running OCR...")
+    # ✅ Use OCR (Tesseract) on the pages where no text was found
+    missing = [i for i, page_text in enumerate(text_pages) if not page_text.strip()]
+    if missing or not text_pages:
+        print(f"🔍 No text found on some pages of {pdf_path}, running OCR...")
         try:
-            images = convert_from_path(pdf_path)
-            ocr_text = ""
-            for i, img in enumerate(images):
-                ocr_text += pytesseract.image_to_string(img) + "\n"
-            text = ocr_text.strip()
+            if text_pages:
+                # Rasterize only the missing pages, one call per run of consecutive pages
+                for first, last in group_page_ranges(missing):
+                    for i, page_text in enumerate(ocr_pdf_pages(pdf_path, first + 1, last + 1), start=first):
+                        text_pages[i] = page_text
+            else:
+                # PDFium could not read the file, so OCR every page
+                text_pages = ocr_pdf_pages(pdf_path)
 
         except Exception as e:
             print(f"⚠️ OCR failed for {pdf_path}: {e}")
-            return "Unknown (OCR failed)"
+            if not any(page_text.strip() for page_text in text_pages):
+                return "Unknown (OCR failed)"
 
+    text = "\n".join(page_text for page_text in text_pages if page_text.strip())
     return text.strip() if text else "Unknown (PDF unreadable)"
 
 
-def classify_comment_by_issue(comment_text, pdf_attached=False):
+@retry(
+    retry=retry_if_exception_type(RateLimitError),
+    wait=wait_random_exponential(min=1, max=60),
+    stop=stop_after_attempt(6),
+    reraise=True
+)
+async def create_chat_completion(**kwargs):
+    """Sends a chat completion request, backing off exponentially on rate limit (429) errors."""
+    return await get_async_client().chat.completions.create(**kwargs)
+
+
+async def classify_comment_by_issue(comment_text, pdf_attached=False):
     """
     Classifies the comment and extracts:
       - who_type (individual, organization, or anonymous)
@@ -91,9 +183,55 @@ def classify_comment_by_issue(comment_text, pdf_attached=False):
             "scientific_legal_support": "No",
         }
 
+    # Reuse the stored classification if this exact request was sent before
+    request = build_classification_request(comment_text, pdf_attached)
+    cache_key = get_classification_cache_key(request)
+    gpt_cache = get_gpt_cache()
+    if cache_key in gpt_cache:
+        return gpt_cache[cache_key]
+
+    try:
+        response = await create_chat_completion(**request)
+
+        summary = parse_classification(response.choices[0].message.content)
+        gpt_cache[cache_key] = summary
+        return summary
+
+    except (json.JSONDecodeError, AttributeError):
+        print("⚠️ JSONDecodeError or invalid response. Using fallback.")
+        return fallback_classification()
+
+    except Exception as e:
+        print(f"⚠️ API Error: {e}. Using fallback.")
+        return fallback_classification()
+
+
+def build_classification_request(comment_text, pdf_attached=False):
+    """Builds the chat completion request body used to classify a comment, directly or through the Batch API."""
+    return {
+        "model": MODEL,
+        "messages": build_classification_messages(comment_text, pdf_attached),
+        "response_format": {"type": "json_object"},
+        "temperature": 0.0,
+    }
+
+
+def get_classification_cache_key(request):
+    """
+    Returns the GPT cache key for a classification request: a SHA-256 of the full request body,
+    so changing the model, the prompt or the truncation limit never reuses a stale classification.
+    """
+    return hashlib.sha256(json.dumps(request, sort_keys=True).encode("utf-8")).hexdigest()
+
+
+def build_classification_messages(comment_text, pdf_attached=False):
+    """Builds the chat messages asking GPT for the fields described in classify_comment_by_issue."""
+
     # If text is too large, truncate to avoid token-limit issues
-    if len(comment_text) > MAX_TOKENS:
-        comment_text = comment_text[:MAX_TOKENS] + " [TRUNCATED]"
+    encoding = get_encoding()
+    token_ids = encoding.encode(comment_text, disallowed_special=())
+    if len(token_ids) > MAX_TOKENS:
+        comment_text = encoding.decode(token_ids[:MAX_TOKENS]) + " [TRUNCATED]"
 
     # 🔹 Prompt to encourage detailed "what", "why", and specific issues
     prompt = f"""
@@ -138,105 +276,249 @@ COMMENT TO ANALYZE:
 \"\"\"{comment_text}\"\"\"
 """
 
-    try:
-        response = client.chat.completions.create(
-            model="gpt-4-turbo",
-            messages=[
-                {"role": "system", "content": "You are an expert policy analyst."},
-                {"role": "user", "content": prompt}
-            ],
-            temperature=0.0
-        )
-        time.sleep(1)
+    return [
+        {"role": "system", "content": "You are an expert policy analyst."},
+        {"role": "user", "content": prompt}
+    ]
 
-        content = response.choices[0].message.content.strip()
-        clean_json = extract_json_block(content)
-        response_data = json.loads(clean_json)
 
-        # Parse issues as a list (in case GPT returns a string)
-        if isinstance(response_data.get("issues", []), list):
-            parsed_issues = response_data["issues"]
-        else:
-            parsed_issues = [response_data.get("issues", "Needs manual review")]
+def parse_classification(content):
+    """Parses GPT's JSON reply into the classification fields. Raises an error if the reply is not valid JSON."""
+    response_data = json.loads(content)
 
-        return {
-            "who_type": response_data.get("who_type", "Unknown"),
-            "who_name": response_data.get("who_name", "Unknown"),
-            "what": response_data.get("what", "Unknown"),
-            "why": response_data.get("why", "Unknown"),
-            "issues": parsed_issues,
-            "scientific_legal_support": response_data.get("scientific_legal_support", "No"),
-        }
+    # Parse issues as a list (in case GPT returns a string)
+    if isinstance(response_data.get("issues", []), list):
+        parsed_issues = response_data["issues"]
+    else:
+        parsed_issues = [response_data.get("issues", "Needs manual review")]
+
+    return {
+        "who_type": response_data.get("who_type", "Unknown"),
+        "who_name": response_data.get("who_name", "Unknown"),
+        "what": response_data.get("what", "Unknown"),
+        "why": response_data.get("why", "Unknown"),
+        "issues": parsed_issues,
+        "scientific_legal_support": response_data.get("scientific_legal_support", "No"),
+    }
+
+
+def fallback_classification():
+    """Returns the placeholder classification used when GPT fails or returns invalid JSON."""
+    return {
+        "who_type": "Unknown",
+        "who_name": "Unknown",
+        "what": "Unknown",
+        "why": "Unknown",
+        "issues": ["Needs manual review"],
+        "scientific_legal_support": "No",
+    }
+
+
+def get_cached_classification(comment):
+    """
+    Returns the cached classification for a prepared comment, or None if it has not been classified yet.
+    """
+    request = build_classification_request(comment["combined_text"], comment["pdf_attached"])
+    return get_gpt_cache().get(get_classification_cache_key(request))
 
-    except (json.JSONDecodeError, AttributeError):
-        print("⚠️ JSONDecodeError or invalid response. Using fallback.")
-        return {
-            "who_type": "Unknown",
-            "who_name": "Unknown",
-            "what": "Unknown",
-            "why": "Unknown",
-            "issues": ["Needs manual review"],
-            "scientific_legal_support": "No",
-        }
 
-    except Exception as e:
-        print(f"⚠️ API Error: {e}. Using fallback.")
-        return {
-            "who_type": "Unknown",
-            "who_name": "Unknown",
-            "what": "Unknown",
-            "why": "Unknown",
-            "issues": ["Needs manual review"],
-            "scientific_legal_support": "No",
-        }
+def build_batch_line(custom_id, request):
+    """Builds one line of a Batch API input file for a chat completion request."""
+    batch_request = {
+        "custom_id": custom_id,
+        "method": "POST",
+        "url": "/v1/chat/completions",
+        "body": request,
+    }
+    return json.dumps(batch_request, ensure_ascii=False) + "\n"
 
 
-def process_json_comments(json_file, pdf_folder):
+def split_batch_requests(chat_requests):
     """
-    Processes all comments stored in a JSON file and extracts text from local PDF attachments.
-    Returns a list of dictionaries, each containing relevant comment data.
+    Splits chat completion requests into consecutive chunks that each stay under BATCH_MAX_REQUESTS,
+    BATCH_MAX_BYTES and BATCH_MAX_TOKENS. Returns the request indexes of each chunk.
     """
-    results = []
+    encoding = get_encoding()
+    chunks = []
+    chunk, chunk_bytes, chunk_tokens = [], 0, 0
+    for i, request in enumerate(chat_requests):
+        request_bytes = len(build_batch_line(str(i), request).encode("utf-8"))
+        request_tokens = sum(len(encoding.encode(m["content"], disallowed_special=())) for m in request["messages"])
+        if chunk and (
+            len(chunk) >= BATCH_MAX_REQUESTS
+            or chunk_bytes + request_bytes > BATCH_MAX_BYTES
+            or chunk_tokens + request_tokens > BATCH_MAX_TOKENS
+        ):
+            chunks.append(chunk)
+            chunk, chunk_bytes, chunk_tokens = [], 0, 0
+        chunk.append(i)
+        chunk_bytes += request_bytes
+        chunk_tokens += request_tokens
+    if chunk:
+        chunks.append(chunk)
+    return chunks
+
+
+def run_classification_batch(comments, chat_requests):
+    """
+    Runs one Batch API job for the given comments and their chat completion requests, and returns the
+    classifications in the same order. The job id is kept in the GPT cache until its results are read,
+    so a re-run after a crash or Ctrl-C resumes the same job instead of paying for a new one.
+    Raises RuntimeError if the job fails, expires or is cancelled (any results it did finish are cached).
+    """
+    client = get_client()
+    gpt_cache = get_gpt_cache()
+    cache_keys = [get_classification_cache_key(request) for request in chat_requests]
+    job_key = "batch:" + hashlib.sha256("".join(cache_keys).encode("utf-8")).hexdigest()
+    summaries = [None] * len(comments)
+
+    batch = None
+    if job_key in gpt_cache:
+        batch = client.batches.retrieve(gpt_cache[job_key])
+        if batch.status in ["failed", "expired", "cancelled"]:
+            batch = None
+        else:
+            print(f"🔁 Resuming batch {batch.id} ({batch.status}) with {len(comments)} comments")
+
+    if batch is None:
+        # Write one chat completion request per comment, using its position as the custom_id
+        with open(BATCH_INPUT_FILE, "w", encoding="utf-8") as f:
+            for i, request in enumerate(chat_requests):
+                f.write(build_batch_line(str(i), request))
+
+        with open(BATCH_INPUT_FILE, "rb") as f:
+            batch_input = client.files.create(file=f, purpose="batch")
+        batch = client.batches.create(
+            input_file_id=batch_input.id,
+            endpoint="/v1/chat/completions",
+            completion_window="24h"
+        )
+        gpt_cache[job_key] = batch.id
+        print(f"📤 Submitted batch {batch.id} with {len(comments)} comments")
+
+    while batch.status not in ["completed", "failed", "expired", "cancelled"]:
+        time.sleep(BATCH_POLL_SECONDS)
+        batch = client.batches.retrieve(batch.id)
+        print(f"⏳ Batch {batch.id} status: {batch.status}")
+
+    # Join the results back to their comments by custom_id (failed requests are in the error file)
+    answered = set()
+    for file_id in [batch.output_file_id, batch.error_file_id]:
+        if not file_id:
+            continue
+        for line in client.files.content(file_id).text.splitlines():
+            result = json.loads(line)
+            index = int(result["custom_id"])
+            answered.add(index)
+            response = result.get("response") or {}
+            if response.get("status_code") != 200:
+                error = result.get("error") or (response.get("body") or {}).get("error")
+                print(f"⚠️ API Error for comment {comments[index]['comment_id']}: {error}. Using fallback.")
+                continue
+            try:
+                summaries[index] = parse_classification(response["body"]["choices"][0]["message"]["content"])
+                gpt_cache[cache_keys[index]] = summaries[index]
+            except (ValueError, KeyError, IndexError, AttributeError):
+                print(f"⚠️ Invalid response for comment {comments[index]['comment_id']}. Using fallback.")
+    gpt_cache.pop(job_key, None)
+
+    if batch.status != "completed":
+        errors = [error.message for error in (batch.errors.data or [])] if batch.errors else []
+        print(f"❌ Batch {batch.id} ended with status '{batch.status}': {'; '.join(errors) or 'no error details'}")
+        raise RuntimeError(f"Batch {batch.id} ended with status '{batch.status}'")
+
+    for index, comment in enumerate(comments):
+        if index not in answered:
+            print(f"⚠️ No result for comment {comment['comment_id']}. Using fallback.")
+    return [summary or fallback_classification() for summary in summaries]
+
+
+def classify_comments_in_batch(comments):
+    """
+    Classifies prepared comments (see prepare_json_comments) with OpenAI Batch API jobs, split to stay within
+    the Batch API limits and run one at a time. Yields (comment, classification) pairs as each job finishes.
+    Callers should skip comments already in the GPT cache (see get_cached_classification).
+    """
+    chat_requests = [build_classification_request(comment["combined_text"], comment["pdf_attached"]) for comment in comments]
+    chunks = split_batch_requests(chat_requests)
+    for number, chunk in enumerate(chunks, start=1):
+        print(f"📦 Batch {number} of {len(chunks)}")
+        summaries = run_classification_batch([comments[i] for i in chunk], [chat_requests[i] for i in chunk])
+        for i, summary in zip(chunk, summaries):
+            yield comments[i], summary
 
-    # Load the JSON data
-    with open(json_file, "r", encoding="utf-8") as f:
-        comments_data = json.load(f)
 
-    print(f"📂 Loaded {len(comments_data)} comments from JSON: {json_file}")
+def load_json_comments(json_file):
+    """Returns the list of comments stored in a JSON file, parsed with orjson."""
+    with open(json_file, "rb") as f:
+        return orjson.loads(f.read())
 
-    # Iterate over each comment in the JSON
-    for comment in comments_data:
-        comment_id = comment.get("comment_id", f"unknown_{len(results)}")
+
+def prepare_json_comments(json_file, pdf_folder, executor):
+    """
+    Loads the comments stored in a JSON file and extracts text from local PDF attachments,
+    using the given process pool. Returns a list of dictionaries with each comment's combined text, ready for classification.
+    """
+    prepared_comments = []
+
+    # List the local PDFs once instead of checking for each attachment on disk
+    pdf_set = set()
+    if os.path.isdir(pdf_folder):
+        pdf_set = {entry.name for entry in os.scandir(pdf_folder) if entry.name.lower().endswith(".pdf")}
+
+    # Collect every comment and its local PDFs first, so the PDFs can be extracted in parallel
+    comment_jobs = []
+    pdf_paths = []
+    for comment in load_json_comments(json_file):
+        comment_id = comment.get("comment_id", f"unknown_{len(comment_jobs)}")
         text_raw = comment.get("text")
         comment_text = text_raw.strip() if isinstance(text_raw, str) else ""
         attachments = comment.get("attachments", [])
-        comment_link = f"https://www.regulations.gov/comment/{comment_id}"
 
-        extracted_texts = []
+        # Count how many PDFs are attached (file_path is None when a download failed)
+        pdf_files = [
+            att.get("file_path") for att in attachments
+            if (att.get("file_path") or "").lower().endswith(".pdf")
+        ]
+        pdf_count = len(pdf_files)
+
+        # Find local PDF attachments (text is extracted via extract_text_from_pdf below)
+        local_pdf_paths = []
+        for file_path in pdf_files:
+            basename = os.path.basename(file_path)
+            local_pdf_path = os.path.join(pdf_folder, basename)
+            if basename in pdf_set:
+                print(f"🔍 Extracting local PDF for comment {comment_id}: {local_pdf_path}")
+                local_pdf_paths.append(local_pdf_path)
+            else:
+                print(f"⚠️ PDF file not found: {local_pdf_path}")
+
+        comment_jobs.append((comment_id, comment_text, pdf_count, local_pdf_paths))
+        pdf_paths.extend(local_pdf_paths)
+
+    print(f"📂 Loaded {len(comment_jobs)} comments from JSON: {json_file}")
+
+    # Extract text from all local PDFs across CPU cores
+    pdf_texts = {}
+    if pdf_paths:
+        pdf_texts = dict(zip(pdf_paths, executor.map(extract_text_from_pdf, pdf_paths)))
 
-        # Count how many PDFs are attached
-        pdf_count = sum(
-            1 for att in attachments
-            if att.get("file_path", "").lower().endswith(".pdf")
-        )
+    # Iterate over each comment in the JSON
+    for comment_id, comment_text, pdf_count, local_pdf_paths in comment_jobs:
+        comment_link = f"https://www.regulations.gov/comment/{comment_id}"
         pdf_attached = (pdf_count > 0)
 
+        extracted_texts = []
+
         # If the comment has actual text, append it
         if comment_text and comment_text.lower() not in ["see attached file(s)", "see attached"]:
             extracted_texts.append(f"Comment Text: {comment_text}")
 
-        # Process local PDF attachments (extract text via extract_text_from_pdf)
-        for attachment in attachments:
-            file_path = attachment.get("file_path", "")
-            if file_path.endswith(".pdf"):
-                local_pdf_path = os.path.join(pdf_folder, os.path.basename(file_path))
-                if os.path.exists(local_pdf_path):
-                    print(f"🔍 Extracting local PDF for comment {comment_id}: {local_pdf_path}")
-                    pdf_text = extract_text_from_pdf(local_pdf_path)
-                    if pdf_text:
-                        extracted_texts.append(f"Extracted PDF Text: {pdf_text}")
-                else:
-                    print(f"⚠️ PDF file not found: {local_pdf_path}")
+        # Add the text extracted from local PDF attachments
+        for local_pdf_path in local_pdf_paths:
+            pdf_text = pdf_texts[local_pdf_path]
+            if pdf_text:
+                extracted_texts.append(f"Extracted PDF Text: {pdf_text}")
 
         # Combine all extracted text
         combined_text = "\n\n".join(extracted_texts).strip()
@@ -246,71 +528,133 @@ def process_json_comments(json_file, pdf_folder):
             print(f"⚠️ Skipping empty comment: {comment_id}")
             continue
 
-        # Classify the combined text with GPT, passing the pdf_attached flag
-        summary = classify_comment_by_issue(combined_text, pdf_attached=pdf_attached)
-
-        # Build final data for CSV
-        data = {
+        prepared_comments.append({
             "comment_id": comment_id,
             "comment_link": comment_link,
-            "who_type": summary["who_type"],
-            "who_name": summary["who_name"],
-            "what": summary["what"],
-            "why": summary["why"],
-            "issues": ", ".join(summary["issues"]),
-            "scientific_legal_support": summary["scientific_legal_support"],
-            "pdf_attachments_present": "Yes" if pdf_attached else "No",
-            "pdf_attachments_count": pdf_count
-        }
+            "combined_text": combined_text,
+            "pdf_attached": pdf_attached,
+            "pdf_count": pdf_count
+        })
+
+    return prepared_comments
+
+
+def build_result_row(comment, summary):
+    """Builds the final CSV row for a prepared comment and its classification."""
+    return {
+        "comment_id": comment["comment_id"],
+        "comment_link": comment["comment_link"],
+        "who_type": summary["who_type"],
+        "who_name": summary["who_name"],
+        "what": summary["what"],
+        "why": summary["why"],
+        "issues": ", ".join(summary["issues"]),
+        "scientific_legal_support": summary["scientific_legal_support"],
+        "pdf_attachments_present": "Yes" if comment["pdf_attached"] else "No",
+        "pdf_attachments_count": comment["pdf_count"]
+    }
+
+
+async def process_json_comments(json_file, pdf_folder, executor):
+    """
+    Processes all comments stored in a JSON file and extracts text from local PDF attachments.
+    Comments are classified concurrently, with at most MAX_CONCURRENT_REQUESTS GPT requests in flight.
+    Returns a list of dictionaries, each containing relevant comment data.
+    """
+    results = []
+    comments = prepare_json_comments(json_file, pdf_folder, executor)
+    semaphore = asyncio.Semaphore(MAX_CONCURRENT_REQUESTS)
+
+    async def classify_with_limit(comment):
+        async with semaphore:
+            # Classify the combined text with GPT, passing the pdf_attached flag
+            return await classify_comment_by_issue(comment["combined_text"], pdf_attached=comment["pdf_attached"])
+
+    summaries = await asyncio.gather(*(classify_with_limit(comment) for comment in comments))
 
-        results.append(data)
-        print(f"✅ Processed JSON comment: {comment_id}")
+    for comment, summary in zip(comments, summaries):
+        results.append(build_result_row(comment, summary))
+        print(f"✅ Processed JSON comment: {comment['comment_id']}")
 
     return results
 
 
+async def process_json_files(json_files, pdf_folder, executor, write_row):
+    """Processes each JSON file in turn on a single event loop, passing every result row to write_row."""
+    for json_file_path in json_files:
+        print(f"📂 Processing JSON file: {json_file_path}")
+        for row in await process_json_comments(json_file_path, pdf_folder, executor):
+            write_row(row)
+
+
 def process_all_comments(json_folder, pdf_folder, output_file):
     """
     Processes multiple JSON files in a folder and extracts all comments.
-    Saves results to a single CSV.
+    Saves results to a single CSV, writing rows as they are produced so partial output survives a crash.
+    Rows go to output_file + ".partial", which only replaces output_file once every comment is written
+    (an existing output_file is left alone if there were no comments to write).
     """
-    results = []
-
     # ✅ Loop through all JSON files in the folder
-    for filename in os.listdir(json_folder):
-        if filename.endswith(".json"):  # Only process JSON files
-            json_file_path = os.path.join(json_folder, filename)
-            print(f"📂 Processing JSON file: {json_file_path}")
-            new_results = process_json_comments(json_file_path, pdf_folder)
-            results.extend(new_results)
-
-    # ✅ Save all results to a single CSV file
-    if results:
-        df = pd.DataFrame(results)
-        df.to_csv(output_file, mode='w', index=False)
-        print(f"\n✅ Processed {len(results)} total comments from all JSON files.")
+    json_files = [
+        os.path.join(json_folder, filename)
+        for filename in os.listdir(json_folder)
+        if filename.endswith(".json")  # Only process JSON files
+    ]
+
+    # Check the API key before spending time on PDF extraction
+    if USE_API:
+        get_api_key()
+
+    partial_file = output_file + ".partial"
+    rows_written = 0
+    with open(partial_file, "w", newline="", encoding="utf-8", buffering=1 << 20) as f:
+        writer = csv.DictWriter(f, fieldnames=OUTPUT_FIELDS)
+        writer.writeheader()
+
+        def write_row(row):
+            nonlocal rows_written
+            writer.writerow(row)
+            rows_written += 1
+            if rows_written % CSV_FLUSH_EVERY == 0:
+                f.flush()
+
+        if USE_API and USE_BATCH_API:
+            # Collect every comment first, then classify them with batch jobs
+            comments = []
+            with ProcessPoolExecutor(max_workers=PDF_WORKERS, initializer=init_pdf_worker) as executor:
+                for json_file_path in json_files:
+                    print(f"📂 Processing JSON file: {json_file_path}")
+                    comments.extend(prepare_json_comments(json_file_path, pdf_folder, executor))
+
+            # Write cached comments right away so they are on disk while the batch runs
+            pending = []
+            for comment in comments:
+                summary = get_cached_classification(comment)
+                if summary is None:
+                    pending.append(comment)
+                else:
+                    write_row(build_result_row(comment, summary))
+            f.flush()
+            print(f"💾 {len(comments) - len(pending)} of {len(comments)} comments found in the GPT cache")
+
+            # A failed batch raises here, leaving only the .partial file behind
+            for comment, summary in classify_comments_in_batch(pending):
+                write_row(build_result_row(comment, summary))
+        else:
+            # One pool of PDF workers is shared by every JSON file, since starting workers is slow on Windows
+            with ProcessPoolExecutor(max_workers=PDF_WORKERS, initializer=init_pdf_worker) as executor:
+                asyncio.run(process_json_files(json_files, pdf_folder, executor, write_row))
+
+    # Keep the previous output if nothing was processed
+    if rows_written:
+        os.replace(partial_file, output_file)
+        print(f"\n✅ Processed {rows_written} total comments from all JSON files.")
         print(f"Output saved to {output_file}")
     else:
+        os.remove(partial_file)
         print("⚠️ No comments were processed. Check if JSON files contain valid data.")
 
 
-import re
-
-def extract_json_block(text):
-    """
-    Extracts the first JSON block from a string using regex.
-    Returns the JSON string or raises ValueError if not found.
-    """
-    match = re.search(r"\{[\s\S]*\}", text)
-    if match:
-        return match.group()
-    else:
-        raise ValueError("No valid JSON found in response.")
-
-
-
-
-
 # 🔹 Run the Script
 if __name__ == "__main__":
     process_all_comments(JSON_FOLDER, PDF_FOLDER, OUTPUT_FILE)
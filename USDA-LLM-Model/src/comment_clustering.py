@@ -1,11 +1,12 @@
 import pandas as pd
+import pyarrow as pa
 import json
 from openai import OpenAI
 from dotenv import load_dotenv
 import os
 from ast import literal_eval
 import re
-from collections import Counter
+from rapidfuzz import process, fuzz
 from math import ceil
 
 # Load OpenAI API key
@@ -18,19 +19,59 @@ CATEGORIZED_OUTPUT = "processed_with_categories.csv"
 SORTED_OUTPUT = "sorted_by_issue.csv"
 GPT_RAW_RESPONSE_LOG = "gpt_issue_grouping_raw.txt"
 CATEGORY_MAPPING_LOG = "gpt_category_consolidation.txt"
+SIMILARITY_THRESHOLD = 95  # Issues at least this similar (0-100) are sent to GPT as a single issue
 
-# Load and clean input
-df = pd.read_csv(INPUT_FILE)
+# Load and clean input (Arrow-backed, so splitting, exploding and sorting stay out of Python objects)
+df = pd.read_csv(INPUT_FILE, dtype_backend="pyarrow")
 df = df[df["issues"].notna()].copy()
-df["issues"] = df["issues"].apply(
-    lambda x: [i.strip() for i in x.split(",")] if isinstance(x, str) else []
-)
+df["issues"] = df["issues"].str.strip().str.split(r"\s*,\s*", regex=True)
 
-# Flatten and count issue frequency
-issue_counter = Counter(issue for issues in df["issues"] for issue in issues)
-all_issues = list(issue_counter.keys())
+# Flatten and count issue frequency (one row per issue, indexed by its comment's row)
+issue_series = df["issues"].explode()
+issue_counter = issue_series.value_counts(sort=False)
+all_issues = list(issue_counter.index)
 print(f"📊 Total unique issues: {len(all_issues)}")
 
+# Merge near-duplicate issues locally so GPT only sees one representative of each
+def normalize_issue(issue):
+    return re.sub(r"\s+", " ", issue).strip().lower()
+
+NEGATION_PREFIXES = ("in", "un", "non", "dis", "de", "im", "ir", "il")  # "humane"/"inhumane" must never be clustered
+
+def is_negation_of(a, b):
+    """Returns True if one of the normalized issues contains a negated form of a word in the other."""
+    words_a, words_b = set(a.split()), set(b.split())
+    for word in words_a ^ words_b:
+        for prefix in NEGATION_PREFIXES:
+            if word.startswith(prefix) and word[len(prefix):] in (words_a | words_b):
+                return True
+    return False
+
+def cluster_similar_issues(issues):
+    """
+    Groups each issue with the first, most frequent representative whose normalized text is at least
+    SIMILARITY_THRESHOLD similar. Issues are only compared against representatives, so clusters never chain.
+    Returns a dict mapping each cluster's representative to all of the issues in the cluster.
+    """
+    clusters = {}
+    representatives = []
+    for issue in sorted(issues, key=issue_counter.get, reverse=True):
+        normalized = normalize_issue(issue)
+        matches = process.extract(
+            normalized, representatives, scorer=fuzz.ratio, score_cutoff=SIMILARITY_THRESHOLD, limit=None
+        )
+        match = next((m for m in matches if not is_negation_of(normalized, m[0])), None)
+        if match:
+            clusters[match[2]].append(issue)
+        else:
+            clusters[len(representatives)] = [issue]
+            representatives.append(normalized)
+    return {members[0]: members for members in clusters.values()}
+
+issue_clusters = cluster_similar_issues(all_issues)
+representative_issues = list(issue_clusters.keys())
+print(f"🧩 Issues after merging near-duplicates: {len(representative_issues)}")
+
 # GPT prompt formatter
 def build_prompt(issues):
     issues = sorted(set(issues))  # Remove duplicates just in case
@@ -45,41 +86,29 @@ INSTRUCTIONS:
 - If in doubt, consolidate — avoid creating overly granular or redundant categories.
 - Categories should reflect common themes across many issues.
 
-Format the result as JSON like this:
-[
-  {{
-    "category": "Broad Issue Category",
-    "related_issues": ["Exact issue string 1", "Exact issue string 2"]
-  }},
-  ...
-]
+Format the result as a JSON object like this:
+{{
+  "groups": [
+    {{
+      "category": "Broad Issue Category",
+      "related_issues": ["Exact issue string 1", "Exact issue string 2"]
+    }},
+    ...
+  ]
+}}
 
 ISSUES:
 {chr(10).join("- " + issue for issue in issues)}
 """
 
-# GPT JSON extractor
-def extract_json_block(text):
-    text = re.sub(r"```(?:json)?", "", text).strip("` \n")
-    match = re.search(r"\[\s*\{[\s\S]*?\}\s*\]", text)
-    if match:
-        json_str = match.group()
-        try:
-            return json.loads(json_str)
-        except json.JSONDecodeError as e:
-            print(f"⚠️ JSON decode failed: {e}")
-    with open("gpt_issue_grouping_failed_batch.txt", "w", encoding="utf-8") as f:
-        f.write(text)
-    raise ValueError("❌ GPT returned invalid or incomplete JSON.")
-
 # Process in batches
 BATCH_SIZE = 500
-num_batches = ceil(len(all_issues) / BATCH_SIZE)
+num_batches = ceil(len(representative_issues) / BATCH_SIZE)
 issue_to_category = {}
 all_categories = set()
 
 for i in range(num_batches):
-    batch_issues = all_issues[i * BATCH_SIZE : (i + 1) * BATCH_SIZE]
+    batch_issues = representative_issues[i * BATCH_SIZE : (i + 1) * BATCH_SIZE]
     print(f"🔄 Processing batch {i+1} of {num_batches} with {len(batch_issues)} issues...")
     prompt = build_prompt(batch_issues)
 
@@ -89,6 +118,7 @@ for i in range(num_batches):
             {"role": "system", "content": "You are a policy analyst categorizing public issues."},
             {"role": "user", "content": prompt}
         ],
+        response_format={"type": "json_object"},
         temperature=0.2
     )
 
@@ -98,17 +128,25 @@ for i in range(num_batches):
         f.write(response_text)
 
     try:
-        issue_groupings = extract_json_block(response_text)
+        issue_groupings = json.loads(response_text)["groups"]
         for group in issue_groupings:
             category = group["category"]
             all_categories.add(category)
             related_issues = group["related_issues"][:200]  # Limit to first 200 to prevent overflow
             for issue in related_issues:
                 issue_to_category[issue] = category
-    except ValueError as e:
+    except (ValueError, KeyError, TypeError):
         print(f"❌ Skipping batch {i+1} due to JSON parsing error.")
         continue
 
+# Give every issue in a cluster its representative's category
+issue_to_category = {
+    issue: issue_to_category[representative]
+    for representative, members in issue_clusters.items()
+    if representative in issue_to_category
+    for issue in members
+}
+
 # Consolidate category names
 def consolidate_categories(categories):
     prompt = f"""
@@ -132,6 +170,7 @@ CATEGORIES:
             {"role": "system", "content": "You are an expert in data cleanup."},
             {"role": "user", "content": prompt}
         ],
+        response_format={"type": "json_object"},
         temperature=0.2
     )
 
@@ -140,7 +179,7 @@ CATEGORIES:
         f.write(raw_text)
 
     try:
-        return json.loads(re.sub(r"```(?:json)?", "", raw_text).strip("` \n"))
+        return json.loads(raw_text)
     except json.JSONDecodeError:
         print("⚠️ Failed to parse category consolidation JSON. Using original categories.")
         return {cat: cat for cat in categories}
@@ -148,21 +187,27 @@ CATEGORIES:
 category_mapping = consolidate_categories(all_categories)
 issue_to_category = {k: category_mapping.get(v, v) for k, v in issue_to_category.items()}
 
-def map_to_categories(issues):
-    categories = set()
-    for issue in issues:
-        category = issue_to_category.get(issue)
-        if category:
-            categories.add(category)
-    return list(categories)
-
-df["high_level_issues"] = df["issues"].apply(map_to_categories)
-df.to_csv(CATEGORIZED_OUTPUT, index=False)
+# Write CSVs with list columns rendered as Python lists, matching the original object-dtype output
+def save_csv(frame, path):
+    list_columns = {
+        column: pd.Series(frame[column].tolist(), index=frame.index, dtype=object)
+        for column in frame.columns
+        if isinstance(frame[column].dtype, pd.ArrowDtype) and pa.types.is_list(frame[column].dtype.pyarrow_dtype)
+    }
+    frame.assign(**list_columns).to_csv(path, index=False)
+
+# Map every issue to its category, then collect each comment's unique categories
+high_level_issues = issue_series.map(issue_to_category).dropna().groupby(level=0).unique().map(list)
+df["high_level_issues"] = high_level_issues.reindex(df.index)
+df["high_level_issues"] = df["high_level_issues"].where(
+    df["high_level_issues"].notna(), pd.Series([[] for _ in range(len(df))], index=df.index)
+).astype(pd.ArrowDtype(pa.list_(pa.string())))  # Comments with no categorized issues get an empty list
+save_csv(df, CATEGORIZED_OUTPUT)
 print(f"✅ Categorized data saved to: {CATEGORIZED_OUTPUT}")
 
 df_exploded = df.explode("high_level_issues")
 df_exploded = df_exploded.rename(columns={"high_level_issues": "issue_category"})
 df_exploded = df_exploded[df_exploded["issue_category"].notna()]
-df_sorted = df_exploded.sort_values(by=["issue_category", "comment_id"])
-df_sorted.to_csv(SORTED_OUTPUT, index=False)
+df_sorted = df_exploded.sort_values(by=["issue_category", "comment_id"], kind="stable")
+save_csv(df_sorted, SORTED_OUTPUT)
 print(f"✅ Sorted data saved to: {SORTED_OUTPUT}")